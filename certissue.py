@@ -1,22 +1,42 @@
 import argparse
 import os
+import re
 import sys
-import csv
+import functools
+import io
+import concurrent.futures
+import multiprocessing
+import img2pdf
+import numpy as np
+import pandas as pd
 from PIL import Image, ImageDraw, ImageFont
 
+# Directory the issued certificates are saved to
+OUTPUT_DIRECTORY = "out"
+
+# Same page size as Pillow's PDF encoder (72 DPI)
+PDF_LAYOUT = img2pdf.get_fixed_dpi_layout_fun((72, 72))
+
+# Per-worker state, set up once by _init_worker
+_base = _fnt = _draw = _png_compress_level = _clean_origin = _clean_region = _xy = _rgb = _write_pdf = None
+
 def main():
 
     # REQUIRED: -x, -y, -i, -s, -fi, -t
-    # OPTIONAL: -fo, -r, -g, -b
+    # OPTIONAL: -fo, -r, -g, -b, -c, -j, -cp
     args = parse_arguments()
     validate_test_mode(args.t) # -t
-    validate_font(args.fo) # -fo
     validate_image_extension(args.i) # -i
-    validate_coordinates(args.x, args.y, args.i) # -x, -y
     validate_csv_extension(args.fi) # -fi
     validate_rgb_colors(args.r, args.g, args.b) # -r, -g, -b
-    names_list, rows_count = get_full_name(args.fi)
-    issue_certificates(names_list, rows_count, args.x, args.y, args.i, args.fi, args.fo, args.s, args.t, args.r, args.g, args.b)
+    validate_png_compress_level(args.png_compress_level) # -c
+    validate_jobs(args.jobs) # -j
+    validate_combined_pdf(args.combined_pdf, args.t) # -cp
+    validate_font(args.fo) # -fo
+    # opening the certification is the slowest check, so it runs last
+    certification = validate_coordinates(args.x, args.y, args.i) # -x, -y
+    first_names, last_names, rows_count = get_full_name(args.fi)
+    issue_certificates(first_names, last_names, rows_count, args.x, args.y, certification, args.fi, args.fo, args.s, args.t, args.r, args.g, args.b, args.jobs, args.png_compress_level, args.combined_pdf)
 
 
 
@@ -45,6 +65,9 @@ def parse_arguments():
     parser.add_argument("-r", help="Red color value, default is 0 (Minimum is 0, Maximum is 255)", type=int, required=False, metavar="Integer", default=0)
     parser.add_argument("-g", help="Green color value, default is 0 (Minimum is 0, Maximum is 255)", type=int, required=False, metavar="Integer", default=0)
     parser.add_argument("-b", help="Blue color value, default is 0 (Minimum is 0, Maximum is 255)", type=int, required=False, metavar="Integer", default=0)
+    parser.add_argument("-c", "--png-compress-level", help="PNG compression level, default is 1 (Minimum is 0, Maximum is 9)", type=int, required=False, metavar="Integer", default=1)
+    parser.add_argument("-j", "--jobs", help="Number of worker processes, default is the number of CPUs", type=int, required=False, metavar="Integer", default=os.cpu_count() or 1)
+    parser.add_argument("-cp", "--combined-pdf", help="Name of a single .PDF file (with the extension) holding every certificate, instead of one .PDF per person", type=str, required=False, metavar="String", default=None)
     args = parser.parse_args()
     return args
 
@@ -72,15 +95,27 @@ def validate_font(font_name):
     :return: True
     :rtype: Boolean
     """
-    fonts_list = os.listdir("fonts")
-    if (font_name not in fonts_list):
+    fonts_set = get_available_fonts()
+    if (font_name not in fonts_set):
         print("Available fonts:")
-        for fonts in fonts_list:
+        for fonts in sorted(fonts_set):
             print(fonts)
         sys.exit()
     return True
 
 
+@functools.lru_cache(maxsize=None)
+def get_available_fonts():
+    """
+    Get the names of the fonts in the fonts/ directory, the directory is only read once
+
+    :return: Names of the available fonts
+    :rtype: frozenset
+    """
+    with os.scandir("fonts") as entries:
+        return frozenset(entry.name for entry in entries if entry.is_file())
+
+
 def validate_image_extension(certification):
     """
     Validates whether the extension of the image is .PNG or not
@@ -107,8 +142,8 @@ def validate_coordinates(x,y,certification):
     :type y: int
     :param certification: Name of the certification file with the extension (.PNG)
     :type certification: str
-    :return: True
-    :rtype: Boolean
+    :return: Opened certification, reused when issuing the certificates
+    :rtype: Image.Image
     """
     img = Image.open(certification)
     width = img.width
@@ -116,7 +151,7 @@ def validate_coordinates(x,y,certification):
     # print(f"{width}. {height}")
     if (x > width or x < 0 or y < 0 or y > height):
         sys.exit("Invalid (x,y) coordinates")
-    return True
+    return img
 
 
 def validate_csv_extension(csv_file):
@@ -157,75 +192,335 @@ def validate_rgb_colors(red, green, blue):
     return True
 
 
+def validate_png_compress_level(png_compress_level):
+    """
+    Validates whether the PNG compression level has a valid value or not
+
+    :param png_compress_level: PNG compression level
+    :type png_compress_level: int
+    :return: True
+    :rtype: Boolean
+    """
+    if (png_compress_level > 9 or png_compress_level < 0):
+        sys.exit("PNG compression level must have value of range [0,9]")
+    return True
+
+
+def validate_jobs(jobs):
+    """
+    Validates whether the number of worker processes is at least 1
+
+    :param jobs: Number of worker processes
+    :type jobs: int
+    :return: True
+    :rtype: Boolean
+    """
+    if (jobs < 1):
+        sys.exit("Jobs must be at least 1")
+    return True
+
+
+def validate_combined_pdf(combined_pdf, test_mode):
+    """
+    Validates whether the combined PDF file, when one is requested, has the .pdf extension and test mode is OFF
+
+    :param combined_pdf: Name of the combined PDF file with the extension (.PDF), or None
+    :type combined_pdf: str
+    :param test_mode: Test mode
+    :type test_mode: str
+    :return: True
+    :rtype: Boolean
+    """
+    if (combined_pdf is None):
+        return True
+    if (test_mode.lower() == "on"):
+        sys.exit("Combined PDF file can only be used when test mode is OFF")
+    name_and_extension = os.path.splitext(combined_pdf)
+    extension = name_and_extension[1].lower()
+    if (extension == ".pdf"):
+        return True
+    sys.exit("Combined PDF file is not a .pdf file")
+
+
 def get_full_name(csv_file):
     """
     Get full name and number of people registered
 
     :param csv_file: Name of the CSV file with the extension (.CSV)
     :type csv_file: str
-    :return: ([],Number)
-    :rtype: (list,int)
+    :return: ([first names],[last names],Number)
+    :rtype: (numpy.ndarray,numpy.ndarray,int)
     """
-    names = []
-    number_of_rows = 0
-    with open(csv_file) as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            names.append({"first_name":row["First name"], "last_name":row["Last name"]})
-            number_of_rows += 1
+    df = pd.read_csv(csv_file, usecols=["First name","Last name"], dtype=str, keep_default_na=False)
+    first_names = df["First name"].to_numpy()
+    last_names = df["Last name"].to_numpy()
 
-    return (names,number_of_rows)
+    return (first_names,last_names,len(df))
 
 
-def issue_certificates(names_list, number_of_rows, x, y, certification, csv_file, font_name, font_size, mode, red, green, blue):
+def sanitize_filename(name):
+    """
+    Replaces the characters that are not allowed in file names (such as / or :) with _
 
-    # When test mode is ON
-    if (mode.lower() == "on"):
-        with Image.open(certification).convert("RGBA") as base:
+    :param name: Full name of the person
+    :type name: str
+    :return: Name that is safe to use as a file name
+    :rtype: str
+    """
+    return re.sub(r"[^\w\- ]", "_", name)
 
-            # make a blank image for the text, initialized to transparent text color
-            txt = Image.new("RGBA", base.size, (255,255,255, 0))
 
-            # get a font (from fonts/ directory)
-            fnt = ImageFont.truetype(f"fonts/{font_name}", font_size)
+def get_output_paths(full_names):
+    """
+    Get the .PNG and .PDF paths of every certificate inside the output directory,
+    names that end up with the same file name get a _2, _3, ... suffix so no certificate is overwritten
 
-            # get a drawing context
-            d = ImageDraw.Draw(txt)
+    :param full_names: Full names of the people registered
+    :type full_names: list
+    :return: [(.PNG path, .PDF path)]
+    :rtype: list
+    """
+    paths = []
+    used_names = set()
+    for full_name in full_names:
+        safe_name = sanitize_filename(full_name)
+
+        # compared case-insensitively, since Windows and macOS file systems are case-insensitive
+        suffix = 1
+        unique_name = safe_name
+        while (unique_name.casefold() in used_names):
+            suffix += 1
+            unique_name = f"{safe_name}_{suffix}"
+        used_names.add(unique_name.casefold())
+        safe_name = unique_name
+
+        paths.append((os.path.join(OUTPUT_DIRECTORY, f"{safe_name}.png"), os.path.join(OUTPUT_DIRECTORY, f"{safe_name}.pdf")))
+    return paths
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(font_name, font_size):
+    """
+    Loads the requested font once and caches it for later calls
 
-            # draw text
-            d.text((x,y),
-            f"{names_list[0]['first_name']} {names_list[0]['last_name']}",
-            font=fnt, fill=(red,green,blue,255))
+    :param font_name: Name of the requested font (.ttf)
+    :type font_name: str
+    :param font_size: Font size
+    :type font_size: int
+    :return: Loaded font
+    :rtype: ImageFont.FreeTypeFont
+    """
+    return ImageFont.truetype(f"fonts/{font_name}", font_size)
 
-            # output as .PDF and .PNG
-            output = Image.alpha_composite(base, txt)
-            rgb_output = output.convert("RGB")
-            rgb_output.save("TEST.pdf", format="PDF", resoultion=100.0)
-            output.save("TEST.png", format="PNG", resolution=100.0)
-            sys.exit("TEST certificates created successfully")
 
-    # When test mode is OFF
-    for i in range(number_of_rows):
-        with Image.open(certification).convert("RGBA") as base:
+def flatten_certification(certification):
+    """
+    Converts the certification to RGB, transparent areas are laid over white instead of turning black
 
-            # make a blank image for the text, initialized to transparent text color
-            txt = Image.new("RGBA", base.size, (255,255,255, 0))
+    :param certification: Opened certification
+    :type certification: Image.Image
+    :return: RGB certification
+    :rtype: Image.Image
+    """
+    if (certification.mode not in ("RGBA", "LA", "PA") and "transparency" not in certification.info):
+        return certification.convert("RGB")
 
-            # get a font (from fonts/ directory)
-            fnt = ImageFont.truetype(f"fonts/{font_name}", font_size)
+    # paste using the alpha channel as mask, fully transparent pixels are left untouched
+    rgba = certification.convert("RGBA")
+    flat = Image.new("RGB", rgba.size, (255,255,255))
+    flat.paste(rgba, mask=rgba)
+    return flat
+
+
+def get_text_region(full_names, x, y, fnt, base):
+    """
+    Get the area of the certification covered by any of the names, drawn at (x,y)
+
+    :param full_names: Full names of the people registered
+    :type full_names: list
+    :param x: x-axis point
+    :type x: int
+    :param y: y-axis point
+    :type y: int
+    :param fnt: Loaded font
+    :type fnt: ImageFont.FreeTypeFont
+    :param base: RGB certification
+    :type base: Image.Image
+    :return: (left, top, right, bottom) box, kept inside the certification
+    :rtype: tuple
+    """
+    # measured like the names are drawn, so names with line breaks cover all of their lines
+    d = ImageDraw.Draw(base)
+    left, top, right, bottom = x, y, x, y
+    for full_name in full_names:
+        l, t, r, b = d.textbbox((x,y), full_name, font=fnt)
+        left, top = min(left, l), min(top, t)
+        right, bottom = max(right, r), max(bottom, b)
+    width, height = base.size
+    return (max(left, 0), max(top, 0), min(right, width), min(bottom, height))
+
+
+def _init_worker(certification, font_name, font_size, png_compress_level, text_region, xy, rgb, write_pdf):
+    """
+    Prepares the certification and the font once per worker process
+
+    :param certification: RGB certification, decoded once by the parent process
+    :type certification: Image.Image
+    :param font_name: Name of the requested font (.ttf)
+    :type font_name: str
+    :param font_size: Font size
+    :type font_size: int
+    :param png_compress_level: PNG compression level
+    :type png_compress_level: int
+    :param text_region: Area of the certification covered by any of the names
+    :type text_region: tuple
+    :param xy: (x,y) point the names are drawn at
+    :type xy: tuple
+    :param rgb: (red,green,blue) color of the names
+    :type rgb: tuple
+    :param write_pdf: Whether a .PDF is written for every person
+    :type write_pdf: bool
+    """
+    global _base, _fnt, _draw, _png_compress_level, _clean_origin, _clean_region, _xy, _rgb, _write_pdf
+    _png_compress_level = png_compress_level
+    _write_pdf = write_pdf
+    _base = certification
+
+    # the point and color are the same for every name, so they are set once instead of sent with each row
+    _xy = xy
+    _rgb = rgb
 
-            # get a drawing context
-            d = ImageDraw.Draw(txt)
+    # keep the blank area under the names, to clear the previous name with a single paste
+    _clean_origin = text_region[:2]
+    _clean_region = _base.crop(text_region)
 
-            # draw text
-            d.text((x,y), f"{names_list[i]['first_name']} {names_list[i]['last_name']}",
-            font=fnt, fill=(red,green,blue,255))
+    # get a font (from fonts/ directory)
+    _fnt = load_font(font_name, font_size)
+
+    # get a drawing context, names are drawn straight onto the certification
+    _draw = ImageDraw.Draw(_base)
+
+
+def _write_bytes(path, data):
+    """
+    Writes already encoded data to a file
+
+    :param path: Path of the file
+    :type path: str
+    :param data: Encoded file content
+    :type data: bytes
+    """
+    with open(path, "wb") as file:
+        file.write(data)
 
-            # output as .PDF and .PNG
-            output = Image.alpha_composite(base, txt)
-            rgb_output = output.convert("RGB")
-            rgb_output.save(f"{names_list[i]['first_name']} {names_list[i]['last_name']}.pdf", format="PDF", resoultion=100.0)
-            output.save(f"{names_list[i]['first_name']} {names_list[i]['last_name']}.PNG", format="PNG", resolution=100.0)
+
+def _render_one(full_name, png_path, pdf_path, io_pool):
+    """
+    Issues the certificate of a single person inside a worker process
+
+    :param full_name: Full name of the person
+    :type full_name: str
+    :param png_path: Path of the .PNG certificate
+    :type png_path: str
+    :param pdf_path: Path of the .PDF certificate
+    :type pdf_path: str
+    :param io_pool: Threads the encoded files are written to disk on
+    :type io_pool: concurrent.futures.ThreadPoolExecutor
+    :return: Pending writes of the .PNG and .PDF
+    :rtype: list
+    """
+    # clear the previous name
+    _base.paste(_clean_region, _clean_origin)
+
+    # draw text
+    _draw.text(_xy, full_name, font=_fnt, fill=_rgb)
+
+    # encode as .PNG, then wrap the same PNG in a .PDF without encoding it again
+    # (a new buffer per row on purpose: getvalue() hands its memory to the writer thread without a copy,
+    # so reusing one buffer would only force that copy on the next write)
+    png = io.BytesIO()
+    _base.save(png, format="PNG", resolution=100.0, compress_level=_png_compress_level, optimize=False)
+    png_bytes = png.getvalue()
+
+    # write both files in the background while the next name is drawn
+    writes = [io_pool.submit(_write_bytes, png_path, png_bytes)]
+    if (_write_pdf):
+        writes.append(io_pool.submit(_write_bytes, pdf_path, img2pdf.convert(png_bytes, layout_fun=PDF_LAYOUT)))
+    return writes
+
+
+def _render_batch(batch):
+    """
+    Issues a batch of certificates inside a worker process, overlapping disk writes with rendering
+
+    :param batch: [(full name, (.PNG path, .PDF path))]
+    :type batch: list
+    """
+    writes = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as io_pool:
+        for full_name, (png_path, pdf_path) in batch:
+            writes.extend(_render_one(full_name, png_path, pdf_path, io_pool))
+
+    # raise any error that happened while writing
+    for write in writes:
+        write.result()
+
+
+def issue_certificates(first_names, last_names, number_of_rows, x, y, certification, csv_file, font_name, font_size, mode, red, green, blue, jobs, png_compress_level, combined_pdf):
+
+    # build every full name once, in a single vectorized pass
+    full_names = np.char.add(np.char.add(first_names[:number_of_rows].astype(str), " "), last_names[:number_of_rows].astype(str)).tolist()
+
+    if (number_of_rows == 0):
+        sys.exit("No certificates created, the CSV file has no rows")
+
+    # decode the certification once and close its file, before any worker is started
+    with certification:
+        base = flatten_certification(certification)
+
+    # When test mode is ON
+    if (mode.lower() == "on"):
+        with base:
+
+            # get a font (from fonts/ directory)
+            fnt = load_font(font_name, font_size)
+
+            # draw text straight onto the certification
+            ImageDraw.Draw(base).text((x,y), full_names[0],
+            font=fnt, fill=(red,green,blue))
+
+            # output as .PNG, then wrap the same PNG in a .PDF, like the issued certificates
+            png = io.BytesIO()
+            base.save(png, format="PNG", resolution=100.0, compress_level=png_compress_level, optimize=False)
+            png_bytes = png.getvalue()
+            _write_bytes("TEST.png", png_bytes)
+            _write_bytes("TEST.pdf", img2pdf.convert(png_bytes, layout_fun=PDF_LAYOUT))
+            sys.exit("TEST certificates created successfully")
+
+    # When test mode is OFF
+    paths = get_output_paths(full_names)
+    os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
+    text_region = get_text_region(full_names, x, y, load_font(font_name, font_size), base)
+    tasks = list(zip(full_names, paths))
+    # no more workers than there are certificates to issue
+    processes = max(1, min(jobs, number_of_rows))
+    batch_size = max(1, number_of_rows // (4 * processes))
+    batches = [tasks[i:i + batch_size] for i in range(0, number_of_rows, batch_size)]
+    # on Linux, forked workers share the decoded certification copy-on-write instead of each holding a copy,
+    # only the pages under the names are copied when a worker draws on it
+    # (other platforms keep their default start method, fork is unsafe with the macOS system libraries)
+    if (sys.platform.startswith("linux")):
+        context = multiprocessing.get_context("fork")
+    else:
+        context = multiprocessing.get_context()
+    if (batches):
+        with context.Pool(processes=processes, initializer=_init_worker, initargs=(base, font_name, font_size, png_compress_level, text_region, (x,y), (red,green,blue), combined_pdf is None)) as pool:
+            pool.map(_render_batch, batches)
+
+    # wrap every saved PNG as one page of a single .PDF
+    if (combined_pdf is not None):
+        with open(combined_pdf, "wb") as pdf:
+            img2pdf.convert([png_path for png_path, pdf_path in paths], layout_fun=PDF_LAYOUT, outputstream=pdf)
 
     sys.exit("Certificates created successfully")
 